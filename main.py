@@ -1,118 +1,350 @@
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, BackgroundTasks, WebSocket, WebSocketDisconnect, Depends, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse, HTMLResponse, Response
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
+from pydantic import BaseModel, Field
 from fastapi.middleware.cors import CORSMiddleware
-from collections import deque
-import statistics
+from fastapi.middleware.gzip import GZipMiddleware
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, asdict
+from array import array
+import asyncio
+import functools
+import hashlib
+import math
+import threading
+import logging
+import logging.handlers
+import atexit
+import queue
+import struct
 import time
 import os
-import psycopg
+import orjson
+import redis.asyncio as aioredis
+try:
+    import fcntl
+except ImportError:  # Windows - lokální vývoj s jedním workerem
+    fcntl = None
+from psycopg_pool import AsyncConnectionPool
 
-app = FastAPI()
+# --- LOGOVÁNÍ ---
+# Handlery requestů jen vloží záznam do fronty, formátování a zápis na stdout
+# obstarává vlákno QueueListeneru - event loop na I/O nečeká.
+# Výchozí QueueHandler.prepare() by zprávu naformátoval ještě ve vlákně
+# requestu, proto ho DroppingQueueHandler přeskakuje. Argumenty logovacích
+# volání se tak čtou až ve vlákně listeneru - nepředávat je a pak měnit.
+# Fronta je omezená: když výpis nestíhá, nové záznamy se zahodí, místo aby
+# rostla paměť nebo se blokoval request.
+LOG_QUEUE_SIZE = 10000
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, který záznam neformátuje a při plné frontě ho tiše zahodí."""
+    def prepare(self, record):
+        # Formátování (včetně tracebacku) udělá až StreamHandler ve vlákně listeneru
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+class DrainingQueueListener(logging.handlers.QueueListener):
+    """QueueListener, jehož ukončovací značka na plnou frontu počká, místo aby selhala."""
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+_log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+_log_listener = DrainingQueueListener(_log_queue, logging.StreamHandler())
+logger = logging.getLogger(__name__)
+logger.addHandler(DroppingQueueHandler(_log_queue))
+# DEBUG výpisy z /api/data jsou v produkci vypnuté, zapnout lze LOG_LEVEL=DEBUG
+logger.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+logger.propagate = False
+_log_listener.start()
+atexit.register(_log_listener.stop)
 
 # --- EXTERNÍ POSTGRESQL DATABÁZE (Render Free Tier) ---
 DATABASE_URL = os.environ.get("DATABASE_URL", "")
 
-def get_db_connection():
-    """Vytvoří připojení k PostgreSQL databázi."""
-    if not DATABASE_URL:
-        print("⚠️ DATABASE_URL není nastavena - používám výchozí hodnoty")
-        return None
-    try:
-        conn = psycopg.connect(DATABASE_URL)
-        return conn
-    except Exception as e:
-        print(f"❌ Chyba připojení k DB: {e}")
-        return None
+# Asynchronní pool spojení - requesty si jen půjčí hotové spojení místo nového
+# TCP+TLS handshaku a při čekání na DB neblokují event loop.
+# 10 spojení odpovídá limitu Render Free Tier. Otevírá/zavírá se v lifespan.
+if DATABASE_URL:
+    db_pool = AsyncConnectionPool(DATABASE_URL, min_size=1, max_size=10, timeout=10, open=False)
+else:
+    db_pool = None
+    logger.warning("⚠️ DATABASE_URL není nastavena - používám výchozí hodnoty")
 
-def init_db():
+async def init_db():
     """Inicializuje tabulku v PostgreSQL."""
-    conn = get_db_connection()
-    if not conn:
+    if db_pool is None:
         return False
     try:
-        cursor = conn.cursor()
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS settings (
-                key TEXT PRIMARY KEY,
-                value REAL
-            )
-        """)
-        # Vložit výchozí hodnoty pokud neexistují
-        cursor.execute("""
-            INSERT INTO settings (key, value) VALUES ('target_temp', 24.0)
-            ON CONFLICT (key) DO NOTHING
-        """)
-        cursor.execute("""
-            INSERT INTO settings (key, value) VALUES ('tank_volume', 50)
-            ON CONFLICT (key) DO NOTHING
-        """)
-        conn.commit()
-        cursor.close()
-        conn.close()
-        print("✅ PostgreSQL databáze inicializována")
+        # Spojení z poolu na konci bloku commitne transakci a vrátí se do poolu
+        async with db_pool.connection() as conn, conn.cursor() as cursor:
+            await cursor.execute("""
+                CREATE TABLE IF NOT EXISTS settings (
+                    key TEXT PRIMARY KEY,
+                    value REAL
+                )
+            """)
+            # Vložit výchozí hodnoty pokud neexistují - jedním dotazem
+            await cursor.execute("""
+                INSERT INTO settings (key, value) VALUES (%s, %s), (%s, %s)
+                ON CONFLICT (key) DO NOTHING
+            """, ("target_temp", 24.0, "tank_volume", 50))
+        logger.info("✅ PostgreSQL databáze inicializována")
         return True
     except Exception as e:
-        print(f"❌ Chyba inicializace DB: {e}")
+        logger.error("❌ Chyba inicializace DB: %s", e)
         return False
 
-def get_setting(key, default=None):
+async def get_setting(key, default=None):
     """Načte hodnotu z PostgreSQL databáze."""
-    conn = get_db_connection()
-    if not conn:
+    if db_pool is None:
         return default
     try:
-        cursor = conn.cursor()
-        cursor.execute("SELECT value FROM settings WHERE key = %s", (key,))
-        result = cursor.fetchone()
-        cursor.close()
-        conn.close()
+        async with db_pool.connection() as conn, conn.cursor() as cursor:
+            await cursor.execute("SELECT value FROM settings WHERE key = %s", (key,))
+            result = await cursor.fetchone()
         if result:
-            print(f"📖 DB čtení: {key} = {result[0]}")
+            logger.debug("📖 DB čtení: %s = %s", key, result[0])
             return result[0]
         return default
     except Exception as e:
-        print(f"❌ Chyba při čtení z DB: {e}")
+        logger.error("❌ Chyba při čtení z DB: %s", e)
         return default
 
-def set_setting(key, value):
+async def load_settings():
+    """Načte všechna nastavení z PostgreSQL jedním dotazem. Bez DB vrací None."""
+    if db_pool is None:
+        return None
+    try:
+        async with db_pool.connection() as conn, conn.cursor() as cursor:
+            await cursor.execute("SELECT key, value FROM settings")
+            return dict(await cursor.fetchall())
+    except Exception as e:
+        logger.error("❌ Chyba při čtení z DB: %s", e)
+        return None
+
+async def set_setting(key, value):
     """Uloží hodnotu do PostgreSQL databáze."""
-    conn = get_db_connection()
-    if not conn:
+    if db_pool is None:
         return False
     try:
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO settings (key, value) VALUES (%s, %s)
-            ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
-        """, (key, value))
-        conn.commit()
-        cursor.close()
-        conn.close()
-        print(f"💾 DB zápis: {key} = {value}")
+        async with db_pool.connection() as conn, conn.cursor() as cursor:
+            await cursor.execute("""
+                INSERT INTO settings (key, value) VALUES (%s, %s)
+                ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
+            """, (key, value))
+        logger.info("💾 DB zápis: %s = %s", key, value)
         return True
     except Exception as e:
-        print(f"❌ Chyba při zápisu do DB: {e}")
+        logger.error("❌ Chyba při zápisu do DB: %s", e)
+        return False
+
+# --- SDÍLENÝ STAV MEZI WORKERY (volitelný Redis) ---
+# S REDIS_URL se current_data a heater_cmd po každém měření zapíšou do Redisu
+# a rozešlou přes pub/sub všem workerům (gunicorn -k uvicorn.workers.UvicornWorker -w N).
+# Každý worker si drží lokální kopii stavu, kterou aktualizuje posluchač
+# kanálu, a přeposílá změny svým WebSocket klientům - GET / tak do Redisu nesahá.
+# Historie (a z ní počítaná analytika) zůstává v každém workeru zvlášť.
+REDIS_URL = os.environ.get("REDIS_URL", "")
+REDIS_STATE_KEY = "akvarko:current_data"
+REDIS_UPDATES_CHANNEL = "akvarko:updates"
+redis_client = None  # Vytvoří se v lifespan, bez REDIS_URL zůstává None
+
+async def publish_state():
+    """
+    Uloží current_data a heater_cmd do Redisu a oznámí změnu všem workerům.
+    Vrací True, pokud se oznámení podařilo odeslat.
+    """
+    if redis_client is None:
+        return False
+    with state_lock:
+        payload = orjson.dumps({"state": state_snapshot(current_data), "heater_cmd": heater_cmd})
+    try:
+        # Zápis i oznámení jedním round-tripem
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.set(REDIS_STATE_KEY, payload)
+            pipe.publish(REDIS_UPDATES_CHANNEL, payload)
+            await pipe.execute()
+    except Exception as e:
+        logger.error("❌ Chyba při zápisu do Redisu: %s", e)
         return False
+    return True
 
-# Inicializace databáze při startu
-init_db()
+async def load_shared_state():
+    """Při startu převezme poslední stav uložený v Redisu."""
+    if redis_client is None:
+        return
+    try:
+        payload = await redis_client.get(REDIS_STATE_KEY)
+    except Exception as e:
+        logger.error("❌ Chyba při čtení z Redisu: %s", e)
+        return
+    if payload is not None:
+        _adopt_shared_state(payload)
+
+async def _redis_listener():
+    """Posluchač kanálu změn - převezme novější stav a pošle ho místním dashboardům."""
+    while True:
+        try:
+            async with redis_client.pubsub() as pubsub:
+                await pubsub.subscribe(REDIS_UPDATES_CHANNEL)
+                async for message in pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+                    _adopt_shared_state(message["data"])
+                    # Zprávu dostane i worker, který ji poslal - rozesílá se jen tady
+                    request_broadcast()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("❌ Chyba odběru z Redisu: %s", e)
+            await asyncio.sleep(5)
+
+def _adopt_shared_state(payload):
+    """
+    Převezme stav od jiného workeru, pokud nese novější měření než lokální current_data.
+    Nastavení (target_temp, tank_volume) nepřebírá - zdrojem pravdy je lokální
+    SETTINGS obnovované z DB, jinak by starší blob přepsal čerstvou změnu.
+    """
+    global heater_cmd, state_version
+    shared = orjson.loads(payload)
+    state = shared["state"]
+    if state["last_timestamp"] <= current_data.last_timestamp:
+        return
+    state["advice"] = tuple(state["advice"])
+    state.pop("target_temp", None)
+    state.pop("tank_volume", None)
+    with state_lock:
+        for name, value in state.items():
+            setattr(current_data, name, value)
+        apply_alert_bits(current_data, current_data.alert_bits)
+        # Monotónní čas jiného procesu tu neplatí - přepočteme ho ze stáří měření
+        current_data.last_seen = time.monotonic() - max(0.0, time.time() - state["last_timestamp"])
+        state_version += 1
+    heater_cmd = shared["heater_cmd"]
 
 # --- GLOBÁLNÍ NASTAVENÍ (cache z databáze) ---
+# Výchozí hodnoty platí, dokud je lifespan při startu nenačte z DB
 SETTINGS = {
-    "target_temp": get_setting("target_temp", 24.0),
-    "tank_volume": int(get_setting("tank_volume", 50))
+    "target_temp": 24.0,
+    "tank_volume": 50
 }
-print(f"📊 Načteno: target_temp={SETTINGS['target_temp']}°C, tank_volume={SETTINGS['tank_volume']}l")
+# Cache se obnovuje z DB úlohou na pozadí jednou za SETTINGS_TTL sekund - při více
+# workerech se změna uložená jiným procesem projeví nejpozději do 30 s.
+# Requesty (hlavně /api/data z ESP32) na databázi nikdy nečekají.
+SETTINGS_TTL = 30
+# Lokální změny nastavení: počet rozpracovaných zápisů do DB a generace
+# (zvyšuje se s každou změnou) - obnova z DB podle nich pozná, že by
+# přepsala čerstvou změnu starší hodnotou z databáze
+_settings_writes = 0
+_settings_generation = 0
+
+@asynccontextmanager
+async def lifespan(app):
+    """
+    Všechny prostředky aplikace se otevírají a zavírají tady, ne při importu.
+    Start: načte historii a spustí její zapisovač, otevře pool, inicializuje DB,
+    načte nastavení, připojí Redis a spustí úlohy na pozadí (obnova nastavení,
+    rozesílání dashboardům, odběr z Redisu).
+    Konec: zruší úlohy, zavře Redis i pool a dopíše historii na disk.
+    """
+    global redis_client, _broadcast_pending
+    start_history_writer()
+    _broadcast_pending = asyncio.Event()
+    tasks = [asyncio.create_task(_broadcaster())]
+    if db_pool is not None:
+        await db_pool.open()
+        await init_db()
+        values = await load_settings() or {}
+        SETTINGS["target_temp"] = values.get("target_temp", SETTINGS["target_temp"])
+        SETTINGS["tank_volume"] = int(values.get("tank_volume", SETTINGS["tank_volume"]))
+        current_data.target_temp = SETTINGS["target_temp"]
+        current_data.tank_volume = SETTINGS["tank_volume"]
+        tasks.append(asyncio.create_task(_settings_refresher()))
+    logger.info("📊 Načteno: target_temp=%s°C, tank_volume=%sl", SETTINGS["target_temp"], SETTINGS["tank_volume"])
+    if REDIS_URL:
+        redis_client = aioredis.from_url(REDIS_URL)
+        await load_shared_state()
+        tasks.append(asyncio.create_task(_redis_listener()))
+        logger.info("🔗 Sdílený stav v Redisu zapnut")
+    
+    yield
+    
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    _broadcast_pending = None
+    if redis_client is not None:
+        await redis_client.aclose()
+        redis_client = None
+    if db_pool is not None:
+        await db_pool.close()
+    stop_history_writer()
+
+# orjson serializuje JSON odpovědi v C místo stdlib json
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
+
+# CORS potřebuje jen prohlížeč (dashboard, API nastavení). Povolené originy lze
+# zúžit proměnnou CORS_ORIGINS (čárkami oddělený seznam), výchozí je "*".
+CORS_ORIGINS = [o.strip() for o in os.environ.get("CORS_ORIGINS", "*").split(",") if o.strip()]
+# Telemetrie z ESP32 CORS nepotřebuje - tyto cesty middleware vůbec neprochází
+TELEMETRY_PATHS = frozenset({"/api/data", "/api/data_batch"})
+
+class DashboardCORSMiddleware(CORSMiddleware):
+    """CORSMiddleware, který requesty na TELEMETRY_PATHS předá aplikaci rovnou."""
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] in TELEMETRY_PATHS:
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
 
 app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
+    DashboardCORSMiddleware,
+    allow_origins=CORS_ORIGINS,
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Komprese HTML dashboardu (inline CSS/JS) a větších JSON odpovědí.
+# Krátké odpovědi pro ESP32 jsou pod minimum_size a posílají se beze změny.
+app.add_middleware(GZipMiddleware, minimum_size=512, compresslevel=5)
+
+# --- STATICKÉ SOUBORY (CSS/JS dashboardu) ---
+# Adresy nesou otisk obsahu (?v=<sha8>), takže je prohlížeč smí cachovat napořád
+# a po změně souboru si sám stáhne novou verzi.
+STATIC_DIR = "static"
+
+class ImmutableStaticFiles(StaticFiles):
+    """StaticFiles s dlouhou cache - obsah pod danou adresou s otiskem se nemění."""
+    def file_response(self, *args, **kwargs):
+        response = super().file_response(*args, **kwargs)
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return response
+
+app.mount("/static", ImmutableStaticFiles(directory=STATIC_DIR), name="static")
+
+@functools.lru_cache(maxsize=None)
+def asset_url(name):
+    """URL statického souboru s otiskem obsahu (spočítá se jednou za běh)."""
+    with open(os.path.join(STATIC_DIR, name), "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()[:8]
+    return f"/static/{name}?v={digest}"
 
 templates = Jinja2Templates(directory="templates")
+templates.env.globals["asset_url"] = asset_url
+# Šablona dashboardu se zkompiluje jednou při startu, bez kontroly změn souboru na disku
+templates.env.auto_reload = False
+DASHBOARD_TPL = templates.get_template("index.html")
+# Poslední vykreslená stránka jako bajty a klíč (verze stavu, status), pro který platí
+_page_key = None
+_page_bytes = b""
+_page_etag = ""  # Slabý ETag z obsahu stránky - shodný napříč workery pro stejná data
 
 # Limity kvality vody (vědecky přesné hodnoty dle požadavků práce)
 PH_MIN = 6.0
@@ -129,113 +361,402 @@ ALARM_TOLERANCE = 1.5
 heater_cmd = False
 
 # --- HISTORIE DAT PRO VĚDECKOU ANALÝZU ---
+class History:
+    """
+    Kruhová historie měření s pevnou kapacitou uložená po sloupcích
+    (array.array pro čas, teplotu, TDS, NTU a pH) s průběžnými součty pro
+    regresi TDS a rozptyl teploty (Welford). Součty se upravují při vložení
+    i při přepsání nejstaršího záznamu, takže analytika nemusí procházet historii.
+    """
+
+    def __init__(self, maxlen):
+        self.maxlen = maxlen
+        # Souvislé sloupce (SoA) místo slovníku na každý záznam
+        self.ts = array("d", bytes(8 * maxlen))
+        self.temp = array("d", bytes(8 * maxlen))
+        self.tds = array("d", bytes(8 * maxlen))
+        self.ntu = array("d", bytes(8 * maxlen))
+        self.ph = array("d", bytes(8 * maxlen))
+        self._head = 0   # Index, kam se zapíše další záznam
+        self._count = 0
+        # Průběžné součty lineární regrese TDS (jen záznamy s TDS > 0).
+        # Čas se sčítá relativně k t0 - Unix čas (~1.7e9) na druhou by
+        # v sum_xx ztrácel přesnost při odečítání n*sum_xx - sum_x².
+        self.t0 = None
+        self.tds_n = 0
+        self.tds_sum_x = 0.0
+        self.tds_sum_y = 0.0
+        self.tds_sum_xy = 0.0
+        self.tds_sum_xx = 0.0
+        # Welfordův akumulátor teploty (jen připojený senzor, temp != -127)
+        self.temp_count = 0
+        self.temp_mean = 0.0
+        self.temp_m2 = 0.0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, entry):
+        i = self._head
+        # Plný buffer - na pozici head leží nejstarší záznam, odečteme ho ze součtů
+        if self._count == self.maxlen:
+            self._remove_stats(self.ts[i] - self.t0, self.temp[i], self.tds[i])
+        else:
+            self._count += 1
+        if self.t0 is None:
+            self.t0 = entry["timestamp"]
+        self.ts[i] = entry["timestamp"]
+        self.temp[i] = entry["temp"]
+        self.tds[i] = entry["tds"]
+        self.ntu[i] = entry["ntu"]
+        self.ph[i] = entry["ph"]
+        self._head = (i + 1) % self.maxlen
+        self._add_stats(entry["timestamp"] - self.t0, entry["temp"], entry["tds"])
+        # Po každé otočce plného bufferu součty přepočítáme načisto
+        if self._head == 0 and self._count == self.maxlen:
+            self._resync()
+
+    def _resync(self):
+        """
+        Přepočítá všechny průběžné součty jedním společným průchodem sloupců,
+        aby se nehromadila zaokrouhlovací chyba z opakovaného přičítání/odečítání.
+        Zároveň posune t0 na nejstarší záznam, aby relativní časy zůstaly malé.
+        """
+        oldest = self._head if self._count == self.maxlen else 0
+        t0 = self.ts[oldest]
+        n = 0
+        sum_x = sum_y = sum_xy = sum_xx = 0.0
+        count = 0
+        mean = m2 = 0.0
+        ts, temps, tds = self.ts, self.temp, self.tds
+        for i in range(self._count):
+            x, t, y = ts[i] - t0, temps[i], tds[i]
+            if y > 0:
+                n += 1
+                sum_x += x
+                sum_y += y
+                sum_xy += x * y
+                sum_xx += x * x
+            if t != -127:
+                count += 1
+                delta = t - mean
+                mean += delta / count
+                m2 += delta * (t - mean)
+        self.t0 = t0
+        self.tds_n = n
+        self.tds_sum_x = sum_x
+        self.tds_sum_y = sum_y
+        self.tds_sum_xy = sum_xy
+        self.tds_sum_xx = sum_xx
+        self.temp_count = count
+        self.temp_mean = mean
+        self.temp_m2 = m2
+
+    def _add_stats(self, x, t, y):
+        if y > 0:
+            self.tds_n += 1
+            self.tds_sum_x += x
+            self.tds_sum_y += y
+            self.tds_sum_xy += x * y
+            self.tds_sum_xx += x * x
+        if t != -127:
+            self.temp_count += 1
+            delta = t - self.temp_mean
+            self.temp_mean += delta / self.temp_count
+            self.temp_m2 += delta * (t - self.temp_mean)
+
+    def _remove_stats(self, x, t, y):
+        if y > 0:
+            self.tds_n -= 1
+            self.tds_sum_x -= x
+            self.tds_sum_y -= y
+            self.tds_sum_xy -= x * y
+            self.tds_sum_xx -= x * x
+        if t != -127:
+            if self.temp_count <= 1:
+                self.temp_count = 0
+                self.temp_mean = 0.0
+                self.temp_m2 = 0.0
+            else:
+                # Zpětný Welfordův krok
+                delta = t - self.temp_mean
+                self.temp_count -= 1
+                self.temp_mean -= delta / self.temp_count
+                self.temp_m2 -= delta * (t - self.temp_mean)
+
 # Ukládáme data jednou za minutu, maxlen=2000 pokryje cca 33 hodin
-history = deque(maxlen=2000)
+history = History(maxlen=2000)
 last_history_save = 0  # Timestamp posledního uložení do historie
 
+# Zámek nad current_data a history - analytika běží v threadpoolu (BackgroundTasks)
+state_lock = threading.Lock()
+# Verze stavu - zvyšuje se (pod state_lock) při každé změně current_data,
+# dashboard podle ní pozná, že musí stránku vykreslit znovu
+state_version = 0
+
 # --- DATOVÉ ÚLOŽIŠTĚ ---
-current_data = {
-    "temp": 0.0,
-    "ph": 0.0,
-    "turbidity": 0,
-    "tds": 0,
-    "water_level": 0,
-    "pump_state": True,        # Předpokládáme, že čerpadlo jede
-    "heater_state": False,
-    "status": "Čekám...",
-    "device_name": "Neznámé",
-    "last_update": "Nikdy",
-    "last_timestamp": 0,
-    "target_temp": SETTINGS["target_temp"],
-    "tank_volume": SETTINGS["tank_volume"],
+@dataclass(slots=True)
+class State:
+    """Aktuální stav akvária - slotová třída místo slovníku se 25 klíči."""
+    temp: float = 0.0
+    ph: float = 0.0
+    turbidity: int = 0
+    tds: int = 0
+    water_level: int = 0
+    pump_state: bool = True        # Předpokládáme, že čerpadlo jede
+    heater_state: bool = False
+    status: str = "Čekám..."
+    device_name: str = "Neznámé"
+    last_update: str = "Nikdy"
+    last_timestamp: float = 0       # Unix čas posledního měření (řazení mezi workery)
+    last_seen: float = 0            # time.monotonic() posledního měření (detekce Offline)
+    target_temp: float = 24.0
+    tank_volume: int = 50
     # Alerty
-    "temp_alert": False,
-    "ph_alert": False,
-    "turbidity_alert": False,
-    "tds_alert": False,
-    "water_level_alert": False,
-    "global_alert": False,
+    temp_alert: bool = False
+    ph_alert: bool = False
+    turbidity_alert: bool = False
+    tds_alert: bool = False
+    water_level_alert: bool = False
+    global_alert: bool = False
+    alert_bits: int = 0             # Maska alertů (ALERT_*) z posledního check_health
     # Doporučení rádce
-    "advice": [],
+    advice: tuple = ()
     # Vědecká analýza
-    "wqi": 0,                    # Water Quality Index (0-100%)
-    "temp_stability": 0.0,       # Tepelná stabilita (směrodatná odchylka)
-    "temp_stability_text": "Nedostatek dat",
-    "tds_prediction_days": None, # Predikce dnů do výměny vody
-    "history_count": 0           # Počet záznamů v historii
-}
+    wqi: int = 0                    # Water Quality Index (0-100%)
+    temp_stability: float = 0.0     # Tepelná stabilita (směrodatná odchylka)
+    temp_stability_text: str = "Nedostatek dat"
+    tds_prediction_days: int | None = None  # Predikce dnů do výměny vody
+    history_count: int = 0          # Počet záznamů v historii
 
-# --- FUNKCE CHYTRÝ RÁDCE (SMART ADVISOR) ---
-def generate_advice(data, volume):
+current_data = State(
+    target_temp=SETTINGS["target_temp"],
+    tank_volume=SETTINGS["tank_volume"],
+)
+
+# --- PERZISTENCE HISTORIE (append-only binární soubor) ---
+# Každý minutový vzorek se připíše jako jeden záznam (čas, teplota, TDS, NTU, pH),
+# takže restart serveru nepřijde o 33 hodin dat.
+HISTORY_FILE = os.environ.get("HISTORY_FILE", "history.bin")
+HISTORY_RECORD = struct.Struct("<dffff")
+
+# Zápis obstarává samostatné vlákno, analytika jen vloží záznam do fronty
+_history_writes = queue.SimpleQueue()
+
+def persist_history_sample(sample):
+    """Zařadí vzorek historie k zápisu na disk (neblokuje)."""
+    _history_writes.put(HISTORY_RECORD.pack(
+        sample["timestamp"], sample["temp"], sample["tds"], sample["ntu"], sample["ph"]
+    ))
+
+def _history_writer():
     """
-    Generuje seznam doporučení na základě naměřených dat a objemu akvária.
-    Vrací seznam slovníků s textem a typem (ok/warning/danger).
+    Vlákno zapisovače - připisuje záznamy z fronty do HISTORY_FILE.
+    Vše, co se ve frontě mezitím nahromadilo (např. dávka z /api/data_batch),
+    zapíše jedním otevřením souboru a jedním write.
     """
-    advice_list = []
-    target = data["target_temp"]
-    temp = data["temp"]
-    
-    # Kontrola TDS (rozpuštěné látky)
-    if data["tds"] > TDS_LIMIT:
-        water_change = volume * 0.3
-        advice_list.append({
-            "text": f"Voda je znečištěná. Vyměň okamžitě 30 % vody (tj. cca {water_change:.0f} litrů).",
-            "type": "danger"
-        })
-    
-    # Kontrola zákalu (turbidity)
-    if data["turbidity"] > TURBIDITY_LIMIT:
-        water_change = volume * 0.2
-        advice_list.append({
-            "text": f"Voda je zakalená. Vyčisti filtr, odkal dno a vyměň {water_change:.0f} litrů vody.",
-            "type": "warning"
-        })
+    running = True
+    while running:
+        records = [_history_writes.get()]
+        try:
+            while True:
+                records.append(_history_writes.get_nowait())
+        except queue.Empty:
+            pass
+        if None in records:
+            running = False
+            records = [r for r in records if r is not None]
+        if not records:
+            continue
+        try:
+            with open(HISTORY_FILE, "ab") as f:
+                f.write(b"".join(records))
+        except OSError as e:
+            logger.error("❌ Chyba při zápisu historie: %s", e)
+
+def load_history():
+    """
+    Načte posledních history.maxlen záznamů z HISTORY_FILE do historie.
+    Záznamy s časem v budoucnosti (chybný timestamp) přeskočí.
+    Pokud soubor narostl na víc než dvojnásobek kapacity nebo obsahoval
+    vadné záznamy, přepíše ho jen platnými.
+    """
+    global last_history_save
+    try:
+        with open(HISTORY_FILE, "rb") as f:
+            raw = f.read()
+    except FileNotFoundError:
+        return
+    except OSError as e:
+        logger.error("❌ Chyba při čtení historie: %s", e)
+        return
     
-    # Kontrola pH - příliš kyselá
-    if data["ph"] < PH_MIN and data["ph"] > 0:
-        soda_amount = volume / 50
-        advice_list.append({
-            "text": f"Voda je příliš kyselá. Přidej jedlou sodu (cca {soda_amount:.1f} kávové lžičky) nebo přípravek pH Plus.",
-            "type": "warning"
-        })
+    size = HISTORY_RECORD.size
+    total = len(raw) // size  # Neúplný poslední záznam (pád při zápisu) ignorujeme
+    now = time.time()
+    records = [r for r in HISTORY_RECORD.iter_unpack(raw[:total * size]) if r[0] <= now]
+    dropped = total - len(records)
+    records = records[-history.maxlen:]
+    keep = len(records)
     
-    # Kontrola pH - příliš zásaditá
-    if data["ph"] > PH_MAX:
-        advice_list.append({
-            "text": "Voda je příliš zásaditá. Přidej přípravek pH Minus nebo kousek rašeliny do filtru.",
-            "type": "warning"
+    for ts, temp, tds, ntu, ph in records:
+        history.append({
+            "timestamp": ts,
+            "temp": round(temp, 1),
+            "tds": int(tds),
+            "ntu": int(ntu),
+            "ph": round(ph, 1)
         })
+        last_history_save = ts
+    current_data.history_count = len(history)
     
-    # Kontrola teploty - příliš studená
-    if temp != -127 and temp < (target - 1.0):
-        heater_power = volume  # Doporučený výkon topítka cca 1W na litr
-        advice_list.append({
-            "text": f"Voda je studená. Zkontroluj topítko. Doporučený výkon topítka pro {volume} l je cca {heater_power} W.",
-            "type": "warning"
-        })
+    if total > 2 * history.maxlen or total * size != len(raw) or dropped:
+        try:
+            tmp_path = HISTORY_FILE + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(b"".join(HISTORY_RECORD.pack(*r) for r in records))
+            os.replace(tmp_path, HISTORY_FILE)
+        except OSError as e:
+            logger.error("❌ Chyba při zkracování historie: %s", e)
     
-    # Kontrola teploty - příliš teplá
-    if temp != -127 and temp > (target + 2.0):
-        advice_list.append({
-            "text": "Voda je příliš teplá. Vypni topítko, přidej provzdušňování nebo polož na hladinu zmrazené PET lahve.",
-            "type": "warning"
-        })
+    logger.info("📈 Načteno %s záznamů historie z %s", keep, HISTORY_FILE)
+
+_history_writer_thread = None
+_history_lock_file = None  # Otevřený zámek souboru historie (jen při více workerech)
+
+def _claim_history_file():
+    """
+    Při více workerech (REDIS_URL) si každý proces zamkne vlastní soubor historie:
+    první history.bin, další history.1.bin, history.2.bin... Záznamy workerů se tak
+    neprokládají a zkracování při startu nepřepíše zápisy jiného procesu.
+    Zámek drží proces až do konce, po restartu se slot znovu použije.
+    """
+    global HISTORY_FILE, _history_lock_file
+    if not REDIS_URL or fcntl is None or _history_lock_file is not None:
+        return
+    base, ext = os.path.splitext(HISTORY_FILE)
+    slot = 0
+    while True:
+        path = HISTORY_FILE if slot == 0 else f"{base}.{slot}{ext}"
+        lock_file = open(path + ".lock", "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            slot += 1
+            continue
+        _history_lock_file = lock_file
+        HISTORY_FILE = path
+        logger.info("📁 Soubor historie tohoto workeru: %s", path)
+        return
+
+def start_history_writer():
+    """Při startu aplikace načte historii ze souboru (jen poprvé) a spustí vlákno zapisovače."""
+    global _history_writer_thread
+    _claim_history_file()
+    if len(history) == 0:
+        load_history()
+    _history_writer_thread = threading.Thread(target=_history_writer, name="history-writer", daemon=True)
+    _history_writer_thread.start()
+
+def stop_history_writer():
+    """Při ukončení aplikace dopíše frontu na disk a zastaví vlákno zapisovače."""
+    global _history_writer_thread
+    if _history_writer_thread is None:
+        return
+    _history_writes.put(None)
+    _history_writer_thread.join(timeout=5)
+    _history_writer_thread = None
+
+# --- FUNKCE CHYTRÝ RÁDCE (SMART ADVISOR) ---
+# Bity pravidel rádce - pořadí bitů odpovídá pořadí zpráv
+ADVICE_TDS = 1 << 0
+ADVICE_TURBIDITY = 1 << 1
+ADVICE_PH_LOW = 1 << 2
+ADVICE_PH_HIGH = 1 << 3
+ADVICE_COLD = 1 << 4
+ADVICE_HOT = 1 << 5
+ADVICE_WATER_LEVEL = 1 << 6
+
+# Statická tabulka pravidel: (bit, typ, text podle objemu akvária v litrech)
+ADVICE_RULES = (
+    (ADVICE_TDS, "danger",
+     lambda volume: f"Voda je znečištěná. Vyměň okamžitě 30 % vody (tj. cca {volume * 0.3:.0f} litrů)."),
+    (ADVICE_TURBIDITY, "warning",
+     lambda volume: f"Voda je zakalená. Vyčisti filtr, odkal dno a vyměň {volume * 0.2:.0f} litrů vody."),
+    (ADVICE_PH_LOW, "warning",
+     lambda volume: f"Voda je příliš kyselá. Přidej jedlou sodu (cca {volume / 50:.1f} kávové lžičky) nebo přípravek pH Plus."),
+    (ADVICE_PH_HIGH, "warning",
+     lambda volume: "Voda je příliš zásaditá. Přidej přípravek pH Minus nebo kousek rašeliny do filtru."),
+    # Doporučený výkon topítka cca 1W na litr
+    (ADVICE_COLD, "warning",
+     lambda volume: f"Voda je studená. Zkontroluj topítko. Doporučený výkon topítka pro {volume} l je cca {volume} W."),
+    (ADVICE_HOT, "warning",
+     lambda volume: "Voda je příliš teplá. Vypni topítko, přidej provzdušňování nebo polož na hladinu zmrazené PET lahve."),
+    (ADVICE_WATER_LEVEL, "warning",
+     lambda volume: "Nízká hladina vody. Doplň odpařenou vodu (nejlépe odstátou nebo přefiltrovanou)."),
+)
+
+ADVICE_OK = {
+    "text": "Voda je v perfektní kondici. Jen tak dál! 🐠",
+    "type": "ok"
+}
+
+def generate_advice(data, volume):
+    """
+    Generuje doporučení na základě naměřených dat a objemu akvária.
+    Vrací n-tici slovníků s textem a typem (ok/warning/danger) - sdílenou
+    z cache, proto se nesmí měnit.
+    """
+    return _advice_for(_advice_mask(data), volume)
+
+def _advice_mask(data):
+    """Vyhodnotí prahy rádce a vrátí bitovou masku pravidel, která platí."""
+    mask = 0
+    target = data.target_temp
+    temp = data.temp
+    ph = data.ph
     
+    # Kontrola TDS (rozpuštěné látky)
+    if data.tds > TDS_LIMIT:
+        mask |= ADVICE_TDS
+    # Kontrola zákalu (turbidity)
+    if data.turbidity > TURBIDITY_LIMIT:
+        mask |= ADVICE_TURBIDITY
+    # Kontrola pH - příliš kyselá / příliš zásaditá
+    if ph < PH_MIN and ph > 0:
+        mask |= ADVICE_PH_LOW
+    if ph > PH_MAX:
+        mask |= ADVICE_PH_HIGH
+    # Kontrola teploty - příliš studená / příliš teplá
+    if temp != -127:
+        if temp < (target - 1.0):
+            mask |= ADVICE_COLD
+        if temp > (target + 2.0):
+            mask |= ADVICE_HOT
     # Kontrola hladiny vody
-    if data["water_level"] < WATER_LEVEL_MIN:
-        advice_list.append({
-            "text": "Nízká hladina vody. Doplň odpařenou vodu (nejlépe odstátou nebo přefiltrovanou).",
-            "type": "warning"
-        })
+    if data.water_level < WATER_LEVEL_MIN:
+        mask |= ADVICE_WATER_LEVEL
     
+    return mask
+
+@functools.lru_cache(maxsize=4)
+def _advice_table(volume):
+    """Předem sestavené slovníky všech pravidel pro daný objem - texty se formátují jen při změně objemu."""
+    return tuple(
+        (bit, {"text": text(volume), "type": advice_type})
+        for bit, advice_type, text in ADVICE_RULES
+    )
+
+@functools.lru_cache(maxsize=256)
+def _advice_for(mask, volume):
+    """Vybere (a zapamatuje) seznam doporučení pro danou masku pravidel a objem."""
+    advice_list = tuple(
+        advice for bit, advice in _advice_table(volume)
+        if mask & bit
+    )
     # Pokud je vše OK
-    if len(advice_list) == 0:
-        advice_list.append({
-            "text": "Voda je v perfektní kondici. Jen tak dál! 🐠",
-            "type": "ok"
-        })
-    
-    return advice_list
+    return advice_list or (ADVICE_OK,)
 
 # --- FUNKCE PRO VĚDECKOU ANALÝZU (SOČ FEATURES) ---
 def calculate_wqi(data):
@@ -243,17 +764,23 @@ def calculate_wqi(data):
     Výpočet Indexu kvality vody (Water Quality Index) 0-100%.
     Vážený průměr penalizující odchylky od ideálních hodnot.
     """
+    return _wqi(data.ph, data.tds, data.turbidity, data.temp, data.target_temp)
+
+@functools.lru_cache(maxsize=64)
+def _wqi(ph, tds, ntu, temp, target):
+    """
+    Jádro výpočtu WQI nad čistými čísly (bez přístupu ke stavu).
+    Hodnoty jsou zaokrouhlené, po sobě jdoucí měření se často opakují - výsledek se pamatuje.
+    """
     score = 100.0
     
     # pH skóre (ideál 7.0, rozsah 6.0-8.2)
-    ph = data["ph"]
     if ph > 0:
         ph_deviation = abs(ph - 7.0)
         ph_penalty = min(ph_deviation * 15, 30)  # Max penalizace 30 bodů
         score -= ph_penalty
     
     # TDS skóre (ideál < 300, limit 500)
-    tds = data["tds"]
     if tds > 500:
         score -= 30  # Kritické - velká penalizace
     elif tds > 300:
@@ -261,7 +788,6 @@ def calculate_wqi(data):
         score -= tds_penalty
     
     # NTU skóre (ideál < 10, limit 30)
-    ntu = data["turbidity"]
     if ntu > 30:
         score -= 25  # Kritické
     elif ntu > 10:
@@ -269,8 +795,6 @@ def calculate_wqi(data):
         score -= ntu_penalty
     
     # Teplota skóre (penalizace za odchylku od cíle)
-    temp = data["temp"]
-    target = data["target_temp"]
     if temp != -127:
         temp_deviation = abs(temp - target)
         if temp_deviation > 2:
@@ -283,51 +807,46 @@ def calculate_wqi(data):
 def calculate_temp_stability(history_data):
     """
     Výpočet tepelné stability jako směrodatná odchylka teploty.
+    Počítá se z Welfordova akumulátoru History v O(1).
     Vrací tuple (hodnota, textový popis).
     """
-    temps = [h["temp"] for h in history_data if h["temp"] != -127]
+    count = history_data.temp_count
     
-    if len(temps) < 5:
+    if count < 5:
         return (0.0, "Nedostatek dat")
     
-    try:
-        stdev = statistics.stdev(temps)
-        
-        if stdev < 0.3:
-            text = "Vynikající stabilita"
-        elif stdev < 0.5:
-            text = "Dobrá stabilita"
-        elif stdev < 1.0:
-            text = "Mírné kolísání"
-        elif stdev < 2.0:
-            text = "Zvýšené kolísání"
-        else:
-            text = "Nestabilní teplota"
-        
-        return (round(stdev, 2), text)
-    except:
-        return (0.0, "Chyba výpočtu")
+    # Výběrová směrodatná odchylka (stejně jako statistics.stdev)
+    stdev = math.sqrt(max(0.0, history_data.temp_m2) / (count - 1))
+    
+    if stdev < 0.3:
+        text = "Vynikající stabilita"
+    elif stdev < 0.5:
+        text = "Dobrá stabilita"
+    elif stdev < 1.0:
+        text = "Mírné kolísání"
+    elif stdev < 2.0:
+        text = "Zvýšené kolísání"
+    else:
+        text = "Nestabilní teplota"
+    
+    return (round(stdev, 2), text)
 
 def predict_tds_maintenance(history_data, current_tds, limit=500):
     """
     Lineární predikce - za kolik dní dosáhne TDS limitu.
+    Počítá se z průběžných součtů History v O(1).
     Vrací počet dní nebo None pokud nelze predikovat.
     """
-    if len(history_data) < 10:
-        return None
-    
-    # Získáme TDS hodnoty s časovými značkami
-    tds_data = [(h["timestamp"], h["tds"]) for h in history_data if h["tds"] > 0]
-    
-    if len(tds_data) < 10:
+    # Počet záznamů s TDS > 0 (nikdy víc než délka historie)
+    n = history_data.tds_n
+    if n < 10:
         return None
     
-    # Jednoduchá lineární regrese
-    n = len(tds_data)
-    sum_x = sum(t[0] for t in tds_data)
-    sum_y = sum(t[1] for t in tds_data)
-    sum_xy = sum(t[0] * t[1] for t in tds_data)
-    sum_xx = sum(t[0] * t[0] for t in tds_data)
+    # Jednoduchá lineární regrese z průběžných součtů
+    sum_x = history_data.tds_sum_x
+    sum_y = history_data.tds_sum_y
+    sum_xy = history_data.tds_sum_xy
+    sum_xx = history_data.tds_sum_xx
     
     denominator = n * sum_xx - sum_x * sum_x
     if denominator == 0:
@@ -351,46 +870,235 @@ def predict_tds_maintenance(history_data, current_tds, limit=500):
     
     return max(1, int(days_to_limit))
 
+# --- PŘEVOD RAW HODNOT Z ESP32 (ADC) ---
+# Předpočítané měřítko ADC: 12-bit (0-4095) na 0-3.3V, resp. na pH 0-14
+ADC_TO_VOLT = 3.3 / 4095.0
+ADC_TO_PH = 14.0 / 4095.0
+
+def convert_raw(raw_ph, raw_tds, raw_turbidity):
+    """
+    Převod RAW ADC hodnot z ESP32 na fyzikální veličiny.
+    Sdílí ho jednotlivý příjem (/api/data) i dávkový příjem (/api/data_batch).
+    Vrací tuple (ph, tds_ppm, ntu).
+    """
+    # --- VÝPOČET pH Z RAW ADC HODNOTY ---
+    # ESP32 ADC: 12-bit (0-4095)
+    # Typický pH senzor: vyšší napětí (RAW) = NIŽŠÍ pH
+    # RAW 4095 (3.3V) = pH 0, RAW 0 (0V) = pH 14
+    # Plynulé mapování celého rozsahu
+    ph_value = round(14.0 - raw_ph * ADC_TO_PH, 1)  # Zaokrouhlení na 1 desetinné místo
+
+    # --- VÝPOČET TDS ---
+    # ESP32 ADC: 12-bit (0-4095), napětí 0-3.3V
+    voltage_tds = raw_tds * ADC_TO_VOLT
+    # TDS senzor: nelineární charakteristika
+    # Vzorec pro TDS modul: TDS = (133.42*V³ - 255.86*V² + 857.39*V) * kompenzace
+    # Kompenzace pro 25°C = 1.0
+    # Hornerovo schéma: ((133.42*V - 255.86)*V + 857.39)*V - bez pow()
+    if voltage_tds < 0.01:
+        tds_value = 0
+    else:
+        tds_value = int(((133.42 * voltage_tds - 255.86) * voltage_tds + 857.39) * voltage_tds)
+    tds_value = max(0, min(1000, tds_value))  # Omezení na 0-1000 PPM
+
+    # --- VÝPOČET ZÁKALU (TURBIDITY) ---
+    # ESP32 ADC: 12-bit (0-4095), napětí 0-3.3V
+    # Dělení (ne násobení ADC_TO_VOLT) schválně - jinak by se na hranicích int()
+    # posunul výsledek o 1 NTU (např. RAW 2730 a 3185)
+    voltage_turb = (raw_turbidity / 4095.0) * 3.3
+    # Turbidity senzor: typicky 4.2V = čistá voda (0 NTU), klesá s kalností
+    # Pro 3.3V max: 3.3V = čistá, 0V = velmi kalná
+    # Empirický vzorec: NTU = -1120.4 * V² + 5742.3 * V - 4352.9 (pro vysoké napětí)
+    # Zjednodušený lineární vzorec pro 0-3.3V: 
+    # 3.0V+ = 0-10 NTU (čistá), 2.5V = ~30 NTU, 2.0V = ~100 NTU
+    # Úseky jsou s klesajícím napětím čím dál strmější (konvexní křivka),
+    # takže platný úsek je vždy ten nejvyšší - stačí max() bez větvení:
+    #   (3.3 - V) * 33          0-10 NTU (čistá)
+    #   10 + (3.0 - V) * 90     10-100 NTU
+    #   100 + (2.0 - V) * 200   100-500+ NTU (velmi kalná)
+    ntu_value = int(max((3.3 - voltage_turb) * 33,
+                        10 + (3.0 - voltage_turb) * 90,
+                        100 + (2.0 - voltage_turb) * 200))
+    ntu_value = max(0, min(500, ntu_value))  # Omezení na 0-500 NTU
+
+    return ph_value, tds_value, ntu_value
+
 # --- FUNKCE PRO KONTROLU ZDRAVÍ (DOKTOR) ---
-def check_health(data):
-    target = data["target_temp"]
-    temp = data["temp"]
-    
+# Bity alertů - jeden int místo pěti samostatných porovnání při zápisu
+ALERT_TEMP = 1 << 0
+ALERT_PH = 1 << 1
+ALERT_TURBIDITY = 1 << 2
+ALERT_TDS = 1 << 3
+ALERT_WATER_LEVEL = 1 << 4
+
+ALERT_FIELDS = (
+    (ALERT_TEMP, "temp_alert"),
+    (ALERT_PH, "ph_alert"),
+    (ALERT_TURBIDITY, "turbidity_alert"),
+    (ALERT_TDS, "tds_alert"),
+    (ALERT_WATER_LEVEL, "water_level_alert"),
+)
+
+def alert_mask(data):
+    """Vyhodnotí všechny limity najednou a vrátí bitovou masku alertů."""
+    return _alert_mask(data.temp, data.ph, data.turbidity, data.tds,
+                       data.water_level, data.target_temp)
+
+@functools.lru_cache(maxsize=64)
+def _alert_mask(temp, ph, ntu, tds, water_level, target):
+    """
+    Jádro vyhodnocení alertů nad čistými čísly. Stejná (zaokrouhlená) měření
+    a cíl dávají stejnou masku - opakované vstupy se vrací z cache.
+    """
     # 1. Dynamický Alarm pro Teplotu
-    # Pokud je teplota mimo rozsah (Cíl +/- 1 stupeň), spustí se alarm
-    if temp != -127:
-        temp_is_bad = (temp < (target - ALARM_TOLERANCE)) or (temp > (target + ALARM_TOLERANCE))
-    else:
-        temp_is_bad = True # Senzor odpojen
-
-    alerts = {
-        "temp_alert": temp_is_bad,
-        "ph_alert": not (PH_MIN <= data["ph"] <= PH_MAX),
-        "turbidity_alert": data["turbidity"] > TURBIDITY_LIMIT,  # Alarm pokud NTU > LIMIT
-        "tds_alert": data["tds"] > TDS_LIMIT,
-        "water_level_alert": data["water_level"] < WATER_LEVEL_MIN
-    }
-    alerts["global_alert"] = any(alerts.values())
-    return alerts
+    # Pokud je teplota mimo rozsah (Cíl +/- ALARM_TOLERANCE) nebo je senzor odpojen (-127), spustí se alarm
+    temp_is_bad = temp == -127 or not (target - ALARM_TOLERANCE <= temp <= target + ALARM_TOLERANCE)
+    
+    return (temp_is_bad * ALERT_TEMP
+            | (not (PH_MIN <= ph <= PH_MAX)) * ALERT_PH
+            | (ntu > TURBIDITY_LIMIT) * ALERT_TURBIDITY  # Alarm pokud NTU > LIMIT
+            | (tds > TDS_LIMIT) * ALERT_TDS
+            | (water_level < WATER_LEVEL_MIN) * ALERT_WATER_LEVEL)
+
+# Jednotlivé příznaky alertů se ve zprávách (WebSocket, Redis) neposílají,
+# příjemce je odvodí z masky alert_bits. Neposílá se ani last_seen -
+# monotónní čas platí jen v procesu, který ho změřil.
+_ALERT_FLAG_NAMES = tuple(name for _, name in ALERT_FIELDS) + ("global_alert",)
+_SNAPSHOT_SKIP = _ALERT_FLAG_NAMES + ("last_seen",)
+
+def state_snapshot(data):
+    """Stav jako slovník pro serializaci - alerty jen jako maska alert_bits, bez last_seen."""
+    state = asdict(data)
+    for name in _SNAPSHOT_SKIP:
+        del state[name]
+    return state
+
+def apply_alert_bits(data, mask):
+    """Rozepíše masku alertů do jednotlivých příznaků (pro šablonu)."""
+    for bit, name in ALERT_FIELDS:
+        setattr(data, name, bool(mask & bit))
+    data.alert_bits = mask
+    data.global_alert = mask != 0
+
+def check_health(data):
+    """
+    Přepočítá alerty a zapíše do stavu jen příznaky, jejichž bit se od
+    minulého vyhodnocení změnil. Vrací masku alertů.
+    """
+    mask = alert_mask(data)
+    changed = mask ^ data.alert_bits
+    if changed:
+        for bit, name in ALERT_FIELDS:
+            if changed & bit:
+                setattr(data, name, bool(mask & bit))
+                # Logují se jen přechody alertů, ustálený stav nic nevypisuje
+                logger.info("🚨 Alert %s: %s", name, "aktivní" if mask & bit else "zrušen")
+        data.alert_bits = mask
+        data.global_alert = mask != 0
+    return mask
+
+def connection_status(data):
+    """
+    Status připojení ESP32 odvozený z času posledního měření - nic nezapisuje.
+    Offline po 20 s bez dat, dokud ESP32 nic neposlalo, zůstává "Čekám...".
+    Monotónní hodiny nepřeskočí při seřízení systémového času (NTP).
+    """
+    last_seen = data.last_seen
+    if last_seen == 0:
+        return data.status
+    if time.monotonic() - last_seen > 20:
+        return "Offline 🔴"
+    return "Online 🟢"
 
 @app.get("/")
 async def dashboard(request: Request):
-    global current_data, SETTINGS
+    """
+    Dashboard jen čte - status se odvodí při vykreslení, current_data se nemění.
+    Cílová teplota a objem v current_data drží aktuální _apply_settings.
+    """
+    global _page_key, _page_bytes, _page_etag
     
-    # Použít IN-MEMORY SETTINGS (NE databázi!)
-    current_data["target_temp"] = SETTINGS["target_temp"]
-    current_data["tank_volume"] = SETTINGS["tank_volume"]
-    print(f"📄 Dashboard: target_temp={SETTINGS['target_temp']}°C z RAM")
+    # Použít IN-MEMORY SETTINGS (NE databázi!), obnovu z DB obstarává úloha na pozadí
+    logger.debug("📄 Dashboard: target_temp=%s°C z RAM", SETTINGS["target_temp"])
     
-    # Offline detekce (20 sekund)
-    time_diff = time.time() - current_data["last_timestamp"]
-    if current_data["last_timestamp"] != 0 and time_diff > 20:
-        current_data["status"] = "Offline 🔴"
-    else:
-        if current_data["last_timestamp"] != 0:
-            current_data["status"] = "Online 🟢"
+    status = connection_status(current_data)
+
+    # Šablona se vykreslí jen po změně stavu, jinak se vrací hotové bajty
+    with state_lock:
+        key = (state_version, status)
+        if key != _page_key:
+            _page_bytes = DASHBOARD_TPL.render(request=request, data=current_data, status=status).encode()
+            _page_etag = f'W/"{hashlib.blake2b(_page_bytes, digest_size=8).hexdigest()}"'
+            _page_key = key
+        body, etag = _page_bytes, _page_etag
+    
+    # Prohlížeč si stránku vždy ověří (no-cache); beze změny dostane jen 304 bez těla
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return HTMLResponse(body, headers=headers)
+
+
+# --- WEBSOCKET PRO ŽIVÝ DASHBOARD ---
+# Místo pravidelného obnovování stránky dostane každý otevřený dashboard
+# po novém měření jednu zprávu se stavem a sám si dočte změněné bloky.
+# Změny se slučují: rozesílá se nejvýše jednou za BROADCAST_INTERVAL sekund,
+# takže dávka měření z ESP32 znamená jednu zprávu na klienta, ne jednu na vzorek.
+active_ws = set()
+BROADCAST_INTERVAL = 0.1
+# Klient, který zprávu nepřevezme do BROADCAST_SEND_TIMEOUT sekund, se odpojí,
+# aby jeden zaseknutý dashboard nezdržoval rozesílání ostatním
+BROADCAST_SEND_TIMEOUT = 5
+_broadcast_pending = None  # asyncio.Event vytvořený v lifespan (patří k event loopu)
+
+def request_broadcast():
+    """Označí stav ke rozeslání - samotné odeslání obstará úloha _broadcaster."""
+    if _broadcast_pending is not None:
+        _broadcast_pending.set()
+
+async def _broadcaster():
+    """Úloha na pozadí: po označení změny rozešle poslední stav a chvíli počká."""
+    while True:
+        await _broadcast_pending.wait()
+        _broadcast_pending.clear()
+        try:
+            await broadcast_state()
+        except Exception as e:
+            logger.error("❌ Chyba při rozesílání stavu: %s", e)
+        await asyncio.sleep(BROADCAST_INTERVAL)
 
-    return templates.TemplateResponse("index.html", {"request": request, "data": current_data})
+@app.websocket("/ws")
+async def websocket_endpoint(websocket: WebSocket):
+    await websocket.accept()
+    active_ws.add(websocket)
+    try:
+        # Klient nic neposílá - čekáme jen na odpojení
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        active_ws.discard(websocket)
+
+async def broadcast_state():
+    """
+    Pošle aktuální stav všem připojeným dashboardům (jedna serializace pro všechny).
+    Dashboard z něj přímo přepíše hodnoty, status připojení posíláme už odvozený.
+    """
+    if not active_ws:
+        return
+    with state_lock:
+        state = state_snapshot(current_data)
+        state["status"] = connection_status(current_data)
+        payload = orjson.dumps(state).decode()
+    clients = list(active_ws)
+    results = await asyncio.gather(
+        *(asyncio.wait_for(ws.send_text(payload), BROADCAST_SEND_TIMEOUT) for ws in clients),
+        return_exceptions=True,
+    )
+    for ws, result in zip(clients, results):
+        if isinstance(result, Exception):
+            active_ws.discard(ws)
 
 
 # --- API PRO NASTAVENÍ (GET/POST) ---
@@ -398,7 +1106,7 @@ async def dashboard(request: Request):
 async def get_settings():
     """Vrací aktuální nastavení pro frontend nebo jiné klienty."""
     global SETTINGS, heater_cmd
-    # Vrátit IN-MEMORY hodnoty (NE z databáze!)
+    # Vrátit IN-MEMORY hodnoty (NE z databáze!), obnovu z DB obstarává úloha na pozadí
     return {
         "target_temp": SETTINGS["target_temp"],
         "tank_volume": SETTINGS["tank_volume"],
@@ -406,217 +1114,374 @@ async def get_settings():
     }
 
 
-@app.post("/api/settings")
-async def update_settings(data: dict):
-    """Aktualizuje nastavení z frontendu. Změny jsou okamžitě platné."""
-    global SETTINGS, current_data, heater_cmd
+async def _apply_settings(data, persist=True):
+    """
+    Společná logika změny nastavení pro /api/settings i /set_target.
+    Hodnota shodná s cache se ignoruje - žádný zápis do DB ani přepočet
+    (frontend posílá nastavení znovu i beze změny).
+    Alerty se přepočítají jen při změně cílové teploty (objem je neovlivňuje),
+    doporučení jen při změně cílové teploty nebo objemu.
+    S persist=False se hodnoty do DB nezapisují (obnova cache z DB).
+    Po změně se stav rozešle dashboardům přes WebSocket.
+    """
+    global SETTINGS, current_data, state_version
     
-    try:
-        # Aktualizace cílové teploty
-        if "target_temp" in data:
-            new_target = float(data["target_temp"])
+    alerts_dirty = False
+    advice_dirty = False
+    
+    # Aktualizace cílové teploty
+    if "target_temp" in data:
+        new_target = float(data["target_temp"])
+        if new_target != SETTINGS["target_temp"]:
+            alerts_dirty = advice_dirty = True
             SETTINGS["target_temp"] = new_target
-            current_data["target_temp"] = new_target
-            set_setting("target_temp", new_target)  # Uložit do DB
-            print(f"🎯 Nová cílová teplota: {new_target}°C")
-        
-        # Aktualizace objemu akvária
-        if "tank_volume" in data:
-            new_volume = max(1, int(data["tank_volume"]))
+            current_data.target_temp = new_target
+            if persist:
+                await _persist_setting("target_temp", new_target)  # Uložit do DB
+            logger.info("🎯 Nová cílová teplota: %s°C", new_target)
+    
+    # Aktualizace objemu akvária
+    if "tank_volume" in data:
+        new_volume = max(1, int(data["tank_volume"]))
+        if new_volume != SETTINGS["tank_volume"]:
+            advice_dirty = True
             SETTINGS["tank_volume"] = new_volume
-            current_data["tank_volume"] = new_volume
-            set_setting("tank_volume", new_volume)  # Uložit do DB
-            print(f"🐠 Nový objem akvária: {new_volume} l")
-        
-        # Přepočítáme alerty a doporučení
-        alerts = check_health(current_data)
-        current_data.update(alerts)
-        
-        advice = generate_advice(current_data, SETTINGS["tank_volume"])
-        current_data["advice"] = advice
+            current_data.tank_volume = new_volume
+            if persist:
+                await _persist_setting("tank_volume", new_volume)  # Uložit do DB
+            logger.info("🐠 Nový objem akvária: %s l", new_volume)
+    
+    if not advice_dirty:
+        return
+    
+    # Přepočítáme jen to, co se změnou mohlo změnit
+    with state_lock:
+        state_version += 1
+        if alerts_dirty:
+            check_health(current_data)
+        if advice_dirty:
+            current_data.advice = generate_advice(current_data, SETTINGS["tank_volume"])
+    # Změnu uvidí hned i dashboardy na ostatních zařízeních
+    request_broadcast()
+
+async def _persist_setting(key, value):
+    """Uloží lokální změnu do DB a po dobu zápisu pozdrží obnovu cache z DB."""
+    global _settings_writes, _settings_generation
+    _settings_generation += 1
+    _settings_writes += 1
+    try:
+        await set_setting(key, value)
+    finally:
+        _settings_writes -= 1
+
+async def refresh_settings():
+    """
+    Znovu načte nastavení z DB (jeden dotaz) a převezme změny provedené
+    jiným workerem. Při nedostupné DB nechá cache beze změny.
+    Když právě probíhá nebo během dotazu proběhla lokální změna, obnovu
+    vynechá - databáze by mohla vrátit ještě starou hodnotu.
+    """
+    if _settings_writes:
+        return
+    generation = _settings_generation
+    values = await load_settings()
+    if not values or _settings_writes or generation != _settings_generation:
+        return
+    changed = {key: value for key, value in values.items()
+               if key in SETTINGS and value is not None and value != SETTINGS[key]}
+    if changed:
+        logger.info("🔄 Nastavení změněno jiným procesem: %s", changed)
+        await _apply_settings(changed, persist=False)
+
+async def _settings_refresher():
+    """Úloha na pozadí: jednou za SETTINGS_TTL sekund obnoví nastavení z DB."""
+    while True:
+        await asyncio.sleep(SETTINGS_TTL)
+        try:
+            await refresh_settings()
+        except Exception as e:
+            logger.error("❌ Chyba při obnově nastavení: %s", e)
+
+class SettingsPayload(BaseModel):
+    """Změna nastavení z frontendu - neposlaný klíč se nemění."""
+    target_temp: float | None = None
+    tank_volume: float | None = None  # Desetinné číslo projde, _apply_settings ho převede na int
+
+@app.post("/api/settings")
+@app.post("/set_target")
+async def update_settings(payload: SettingsPayload):
+    """
+    Aktualizuje nastavení z frontendu. Změny jsou okamžitě platné.
+    /set_target je starší cesta používaná dashboardem - odpověď proto nese
+    i původní klíče "target" a "volume".
+    Neplatné hodnoty odmítne validace modelu (HTTP 422).
+    """
+    global SETTINGS, heater_cmd
+    
+    try:
+        await _apply_settings(payload.model_dump(exclude_none=True))
         
         return {
             "status": "ok",
             "target_temp": SETTINGS["target_temp"],
             "tank_volume": SETTINGS["tank_volume"],
+            "target": SETTINGS["target_temp"],
+            "volume": SETTINGS["tank_volume"],
             "heater_cmd": heater_cmd
         }
     except Exception as e:
-        print(f"❌ Chyba při aktualizaci nastavení: {e}")
+        logger.error("❌ Chyba při aktualizaci nastavení: %s", e)
         return {"status": "error", "message": str(e)}
 
-@app.post("/api/data")
-async def receive_data(data: dict):
-    global current_data, heater_cmd, history, last_history_save, SETTINGS
-    
-    # POUŽÍT IN-MEMORY SETTINGS jako zdroj pravdy (NE databázi!)
-    # Databáze se používá jen při startu a při uživatelských změnách
-    target_temp = SETTINGS["target_temp"]
-    tank_volume = SETTINGS["tank_volume"]
-    current_data["target_temp"] = target_temp
-    current_data["tank_volume"] = tank_volume
-    
-    current_timestamp = time.time()
-    formatted_time = time.strftime("%H:%M:%S", time.localtime(current_timestamp))
+# Cache naformátovaného času (HH:MM:SS) - volá se jen z event loopu, zámek netřeba
+_last_fmt_sec = -1
+_last_fmt_str = ""
 
-    # Načtení a zaokrouhlení teploty
-    raw_temp = data.get("temp", -127)
-    if raw_temp != -127:
-        temp = round(float(raw_temp), 1)  # Zaokrouhlení na 1 desetinné místo
-    else:
-        temp = -127
+def _format_time(timestamp):
+    """Formát HH:MM:SS pro dashboard, přepočítaný nejvýše jednou za vteřinu."""
+    global _last_fmt_sec, _last_fmt_str
+    sec = int(timestamp)
+    if sec != _last_fmt_sec:
+        _last_fmt_str = time.strftime("%H:%M:%S", time.localtime(sec))
+        _last_fmt_sec = sec
+    return _last_fmt_str
 
-    # --- VÝPOČET pH Z RAW ADC HODNOTY ---
-    raw_ph = data.get("ph", 0)
-    # ESP32 ADC: 12-bit (0-4095)
-    # Typický pH senzor: vyšší napětí (RAW) = NIŽŠÍ pH
-    # RAW 4095 (3.3V) = pH 0, RAW 0 (0V) = pH 14
-    # Plynulé mapování celého rozsahu
-    ph_value = 14.0 - (raw_ph / 4095.0) * 14.0
-    ph_value = round(ph_value, 1)  # Zaokrouhlení na 1 desetinné místo
-    voltage_ph = (raw_ph / 4095.0) * 3.3
-    print(f"📊 pH: RAW={raw_ph}, Voltage={voltage_ph:.2f}V, pH={ph_value}")
+# --- OMEZENÍ RYCHLOSTI TELEMETRIE (token bucket na IP adresu) ---
+# Chybný firmware nebo cizí klient nesmí zahltit /api/data a tím i analytiku
+# a rozesílání dashboardům. Krátký nápor se pozdrží, trvalý dostane 429.
+RATE_LIMIT_RATE = float(os.environ.get("RATE_LIMIT_RATE", 5))    # Požadavků za sekundu
+RATE_LIMIT_BURST = int(os.environ.get("RATE_LIMIT_BURST", 10))   # Velikost zásobníku
+RATE_LIMIT_MAX_WAIT = 1.0    # Nejdelší pozdržení požadavku v sekundách
+RATE_LIMIT_MAX_CLIENTS = 1000
 
-    # --- VÝPOČET TDS ---
-    raw_tds = data.get("tds", 0)
-    # ESP32 ADC: 12-bit (0-4095), napětí 0-3.3V
-    voltage_tds = (raw_tds / 4095.0) * 3.3
-    # TDS senzor: nelineární charakteristika
-    # Vzorec pro TDS modul: TDS = (133.42*V³ - 255.86*V² + 857.39*V) * kompenzace
-    # Kompenzace pro 25°C = 1.0
-    if voltage_tds < 0.01:
-        tds_value = 0
-    else:
-        tds_value = int(133.42 * pow(voltage_tds, 3) - 255.86 * pow(voltage_tds, 2) + 857.39 * voltage_tds)
-    tds_value = max(0, min(1000, tds_value))  # Omezení na 0-1000 PPM
-    print(f"📊 TDS: RAW={raw_tds}, Voltage={voltage_tds:.2f}V, TDS={tds_value} PPM")
+class TokenBucket:
+    """Token bucket pro jednoho klienta."""
+    __slots__ = ("tokens", "updated")
 
-    # --- VÝPOČET ZÁKALU (TURBIDITY) ---
-    raw_turbidity = data.get("turbidity", 0)
-    # ESP32 ADC: 12-bit (0-4095), napětí 0-3.3V
-    voltage_turb = (raw_turbidity / 4095.0) * 3.3
-    # Turbidity senzor: typicky 4.2V = čistá voda (0 NTU), klesá s kalností
-    # Pro 3.3V max: 3.3V = čistá, 0V = velmi kalná
-    # Empirický vzorec: NTU = -1120.4 * V² + 5742.3 * V - 4352.9 (pro vysoké napětí)
-    # Zjednodušený lineární vzorec pro 0-3.3V: 
-    # 3.0V+ = 0-10 NTU (čistá), 2.5V = ~30 NTU, 2.0V = ~100 NTU
-    if voltage_turb >= 3.0:
-        ntu_value = int((3.3 - voltage_turb) * 33)  # 0-10 NTU
-    elif voltage_turb >= 2.0:
-        ntu_value = int(10 + (3.0 - voltage_turb) * 90)  # 10-100 NTU
+    def __init__(self):
+        self.tokens = float(RATE_LIMIT_BURST)
+        self.updated = time.monotonic()
+
+    def acquire(self):
+        """Odebere token a vrátí, kolik sekund musí požadavek počkat (0 = ihned)."""
+        now = time.monotonic()
+        self.tokens = min(RATE_LIMIT_BURST, self.tokens + (now - self.updated) * RATE_LIMIT_RATE)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / RATE_LIMIT_RATE
+
+    def refund(self):
+        self.tokens += 1
+
+_rate_buckets = {}
+
+async def rate_limit(request: Request):
+    """Závislost pro telemetrické endpointy - pozdrží nebo odmítne příliš časté požadavky."""
+    client = request.client.host if request.client else "?"
+    bucket = _rate_buckets.get(client)
+    if bucket is None:
+        # Ochrana paměti před mnoha různými adresami
+        if len(_rate_buckets) >= RATE_LIMIT_MAX_CLIENTS:
+            _rate_buckets.clear()
+        bucket = _rate_buckets[client] = TokenBucket()
+    wait = bucket.acquire()
+    if wait > RATE_LIMIT_MAX_WAIT:
+        bucket.refund()
+        logger.warning("⛔ Příliš mnoho požadavků z %s", client)
+        raise HTTPException(status_code=429, detail="Příliš mnoho požadavků")
+    if wait > 0:
+        await asyncio.sleep(wait)
+
+# --- DATA Z ESP32 ---
+class SensorPayload(BaseModel):
+    """
+    Jedno měření z ESP32. Pydantic typy ověří a převede při parsování,
+    chybějící klíče dostanou výchozí hodnoty. pH, TDS a zákal jsou RAW hodnoty ADC.
+    Číselná pole jsou float - firmware může poslat i průměrovanou hodnotu (např. 2000.5).
+    """
+    temp: float = -127          # -127 = odpojený senzor DS18B20
+    ph: float = 0
+    tds: float = 0
+    turbidity: float = 0
+    water_level: float = 0
+    pump_state: bool = True
+    heater_state: bool = False
+    device_name: str = "ESP32"
+    timestamp: float | None = None  # Jen v dávce - Unix čas měření
+
+# Nejvíc vzorků v jedné dávce (ESP32 je po výpadku Wi-Fi posílá najednou)
+MAX_BATCH_SAMPLES = 500
+
+class SensorBatch(BaseModel):
+    """Dávka měření z ESP32 pro /api/data_batch."""
+    samples: list[SensorPayload] = Field(default=[], max_length=MAX_BATCH_SAMPLES)
+
+def _sample_time(timestamp, received_at):
+    """
+    Čas vzorku z dávky. Chybějící nebo nevěrohodný timestamp (v budoucnosti,
+    např. v milisekundách, nebo starší než celé okno historie) nahradí časem příjmu,
+    aby nerozbil vzorkování historie ani soubor s historií.
+    """
+    if timestamp is None or not (received_at - history.maxlen * 60 <= timestamp <= received_at):
+        return received_at
+    return timestamp
+
+def _parse_reading(data, timestamp):
+    """Převede jedno měření z ESP32 na vzorek historie (fyzikální hodnoty)."""
+    # Načtení a zaokrouhlení teploty
+    raw_temp = data.temp
+    if raw_temp != -127:
+        temp = round(raw_temp, 1)  # Zaokrouhlení na 1 desetinné místo
     else:
-        ntu_value = int(100 + (2.0 - voltage_turb) * 200)  # 100-500+ NTU (velmi kalná)
-    ntu_value = max(0, min(500, ntu_value))  # Omezení na 0-500 NTU
-    print(f"📊 Turbidity: RAW={raw_turbidity}, Voltage={voltage_turb:.2f}V, NTU={ntu_value}")
+        temp = -127
 
-    # Logika Termostatu (Ovládání topení)
-    target = current_data["target_temp"]
-    print(f"🌡️ Termostat: aktuální={temp}°C, cíl={target}°C")
+    raw_ph = data.ph
+    raw_tds = data.tds
+    raw_turbidity = data.turbidity
+    ph_value, tds_value, ntu_value = convert_raw(raw_ph, raw_tds, raw_turbidity)
     
-    if temp != -127:
-        if temp < target:
-            heater_cmd = True  # Zapnout topení - je pod cílem
-            print(f"🔥 Topení ZAPNUTO (temp {temp} < cíl {target})")
-        else:
-            heater_cmd = False  # Vypnout - dosáhli jsme cíle
-            print(f"❄️ Topení VYPNUTO (temp {temp} >= cíl {target})")
+    # Debug výpis RAW hodnot (líné formátování - bez nákladů, když je DEBUG vypnutý)
+    logger.debug("📊 RAW: pH=%s, TDS=%s, Turb=%s", raw_ph, raw_tds, raw_turbidity)
     
-    current_data.update({
+    return {
+        "timestamp": timestamp,
         "temp": temp,
-        "ph": ph_value,          # Uložení vypočtené hodnoty pH (0-14)
-        "turbidity": ntu_value,  # Uložení vypočtené hodnoty v NTU
-        "tds": tds_value,        # Uložení vypočtené hodnoty v PPM
-        "water_level": data.get("water_level", 0),
-        "pump_state": data.get("pump_state", True),
-        "heater_state": data.get("heater_state", False),
-        "device_name": data.get("device_name", "ESP32"),
-        "status": "Online 🟢",
-        "last_update": formatted_time,
-        "last_timestamp": current_timestamp,
-        # target_temp neměníme, zůstává nastavená uživatelem
-    })
-    
-    # --- SMART SAMPLING: Ukládání do historie jednou za minutu ---
-    if current_timestamp - last_history_save >= 60:
-        history.append({
-            "timestamp": current_timestamp,
-            "temp": temp,
-            "tds": tds_value,
-            "ntu": ntu_value,
-            "ph": ph_value
-        })
-        last_history_save = current_timestamp
-        current_data["history_count"] = len(history)
+        "tds": tds_value,
+        "ntu": ntu_value,
+        "ph": ph_value
+    }
+
+def _store_reading(data, sample, received_at):
+    """Termostat a zápis posledního měření do current_data. Vrací příkaz pro topení."""
+    global current_data, heater_cmd, SETTINGS, state_version
+    
+    # POUŽÍT IN-MEMORY SETTINGS jako zdroj pravdy (NE databázi!)
+    # Databáze se používá při startu, při uživatelských změnách a pro obnovu po TTL.
+    # Hodnota se načte jednou do lokální proměnné; current_data.target_temp
+    # a tank_volume drží aktuální už _apply_settings, tady se nepřepisují.
+    target = SETTINGS["target_temp"]
+    
+    formatted_time = _format_time(received_at)
+    temp = sample["temp"]
+
+    # Logika Termostatu (Ovládání topení) - ESP32 dostane příkaz hned v odpovědi
+    # Pod cílem topí, po dosažení cíle vypne; s odpojeným senzorem drží poslední stav
+    if temp != -127:
+        new_cmd = temp < target
+        # Logujeme jen přepnutí topení, ne každé měření
+        if new_cmd != heater_cmd:
+            logger.info("🌡️ Termostat: topení %s (aktuální=%s°C, cíl=%s°C)",
+                        "ZAPNUTO" if new_cmd else "VYPNUTO", temp, target)
+        heater_cmd = new_cmd
     
-    alerts = check_health(current_data)
-    current_data.update(alerts)
+    with state_lock:
+        state_version += 1
+        state = current_data
+        state.temp = temp
+        state.ph = sample["ph"]          # Uložení vypočtené hodnoty pH (0-14)
+        state.turbidity = sample["ntu"]  # Uložení vypočtené hodnoty v NTU
+        state.tds = sample["tds"]        # Uložení vypočtené hodnoty v PPM
+        state.water_level = round(data.water_level)  # Celá procenta pro dashboard
+        state.pump_state = data.pump_state
+        state.heater_state = data.heater_state
+        state.device_name = data.device_name
+        state.status = "Online 🟢"
+        state.last_update = formatted_time
+        state.last_timestamp = received_at
+        state.last_seen = time.monotonic()
     
-    # Generování doporučení od Chytrého rádce
-    advice = generate_advice(current_data, current_data["tank_volume"])
-    current_data["advice"] = advice
+    logger.debug("✅ Data: %s°C (Cíl: %s°C) | pH: %s | TDS: %s PPM | Zákal: %s NTU | Topení: %s",
+                 temp, target, sample["ph"], sample["tds"], sample["ntu"], heater_cmd)
+    return heater_cmd
+
+@app.post("/api/data", dependencies=[Depends(rate_limit)])
+async def receive_data(data: SensorPayload, background_tasks: BackgroundTasks):
+    """
+    Příjem dat z ESP32. Na event loopu proběhne jen převod RAW hodnot,
+    termostat a zápis do current_data - analytika běží až po odeslání odpovědi.
+    """
+    current_timestamp = time.time()
+    sample = _parse_reading(data, current_timestamp)
+    cmd = _store_reading(data, sample, current_timestamp)
     
-    # --- VĚDECKÁ ANALÝZA ---
-    # Výpočet WQI (Water Quality Index)
-    current_data["wqi"] = calculate_wqi(current_data)
+    # Analytika doběhne v threadpoolu po odeslání odpovědi
+    background_tasks.add_task(_analytics_task, [sample])
     
-    # Výpočet tepelné stability
-    stability, stability_text = calculate_temp_stability(list(history))
-    current_data["temp_stability"] = stability
-    current_data["temp_stability_text"] = stability_text
+    return {"message": "Data saved", "heater_cmd": cmd}
+
+@app.post("/api/data_batch", dependencies=[Depends(rate_limit)])
+async def receive_data_batch(data: SensorBatch, background_tasks: BackgroundTasks):
+    """
+    Dávkový příjem dat z ESP32 ve tvaru {"samples": [...]} (např. po výpadku Wi-Fi).
+    Vzorek může nést vlastní "timestamp" (Unix čas v sekundách), jinak nebo
+    při nevěrohodné hodnotě se použije čas příjmu.
+    Aktuální stav a příkaz pro topení určuje poslední vzorek.
+    """
+    samples = data.samples
+    if not samples:
+        return {"message": "No samples", "heater_cmd": heater_cmd}
     
-    # Predikce údržby (TDS)
-    current_data["tds_prediction_days"] = predict_tds_maintenance(list(history), tds_value, TDS_LIMIT)
+    current_timestamp = time.time()
+    parsed = [
+        _parse_reading(s, _sample_time(s.timestamp, current_timestamp))
+        for s in samples
+    ]
+    cmd = _store_reading(samples[-1], parsed[-1], current_timestamp)
     
-    # Debug výpis RAW hodnot a vypočtených hodnot
-    print(f"📊 RAW: pH={raw_ph}, TDS={raw_tds}, Turb={raw_turbidity}")
-    print(f"✅ Data: {temp}°C (Cíl: {target}°C) | pH: {ph_value} | TDS: {tds_value} PPM | Zákal: {ntu_value} NTU | Topení: {heater_cmd}")
+    background_tasks.add_task(_analytics_task, parsed)
     
-    return {"message": "Data saved", "heater_cmd": heater_cmd}
+    return {"message": "Data saved", "samples": len(parsed), "heater_cmd": cmd}
 
-@app.post("/set_target")
-async def set_target(data: dict):
-    global SETTINGS, current_data, heater_cmd
-    try:
-        # Uživatel změnil cílovou teplotu na webu
-        if "target_temp" in data:
-            new_target = float(data.get("target_temp", 24.0))
-            SETTINGS["target_temp"] = new_target
-            current_data["target_temp"] = new_target
-            set_setting("target_temp", new_target)  # Uložit do DB
-            print(f"🎯 [set_target] Nová cílová teplota: {new_target}°C")
+async def _analytics_task(samples):
+    """Analytika v threadpoolu, poté zveřejnění nového stavu workerům a dashboardům."""
+    await run_in_threadpool(_recompute_analytics, samples)
+    # S Redisem dostanou stav přes pub/sub všechny workery (i tento) a rozešlou ho
+    # svým dashboardům. Bez Redisu nebo při jeho výpadku rozešleme aspoň místně.
+    if not await publish_state():
+        request_broadcast()
+
+def _recompute_analytics(samples):
+    """
+    Uloží vzorky do historie a přepočítá alerty, doporučení a vědeckou
+    analýzu nad current_data. Běží jako BackgroundTask v threadpoolu,
+    takže neblokuje event loop.
+    """
+    global last_history_save, state_version
+    
+    with state_lock:
+        state_version += 1
+        # --- SMART SAMPLING: Ukládání do historie jednou za minutu ---
+        for sample in samples:
+            if sample["timestamp"] - last_history_save >= 60:
+                history.append(sample)
+                persist_history_sample(sample)
+                last_history_save = sample["timestamp"]
+        current_data.history_count = len(history)
         
-        # Uživatel změnil objem akvária
-        if "tank_volume" in data:
-            new_volume = max(1, int(data.get("tank_volume", 50)))
-            SETTINGS["tank_volume"] = new_volume
-            current_data["tank_volume"] = new_volume
-            set_setting("tank_volume", new_volume)  # Uložit do DB
-            print(f"🐠 [set_target] Nový objem akvária: {new_volume} l")
+        check_health(current_data)
         
-        # Hned přepočítáme alerty s novou cílovou teplotou
-        alerts = check_health(current_data)
-        current_data.update(alerts)
+        # Generování doporučení od Chytrého rádce
+        current_data.advice = generate_advice(current_data, current_data.tank_volume)
         
-        # Přegenerujeme doporučení
-        advice = generate_advice(current_data, SETTINGS["tank_volume"])
-        current_data["advice"] = advice
+        # --- VĚDECKÁ ANALÝZA ---
+        # Výpočet WQI (Water Quality Index)
+        current_data.wqi = calculate_wqi(current_data)
         
-        return {
-            "status": "ok", 
-            "target": SETTINGS["target_temp"],
-            "volume": SETTINGS["tank_volume"],
-            "heater_cmd": heater_cmd
-        }
-    except Exception as e:
-        print(f"❌ Chyba v set_target: {e}")
-        return {"status": "error", "message": str(e)}
-
+        # Výpočet tepelné stability
+        stability, stability_text = calculate_temp_stability(history)
+        current_data.temp_stability = stability
+        current_data.temp_stability_text = stability_text
+        
+        # Predikce údržby (TDS)
+        current_data.tds_prediction_days = predict_tds_maintenance(history, current_data.tds, TDS_LIMIT)
 
 @app.get("/debug")
 async def debug_settings():
     """Debug endpoint - ukazuje co je v RAM vs co je v DB."""
-    db_target = get_setting("target_temp", "CHYBA")
-    db_volume = get_setting("tank_volume", "CHYBA")
+    db_target = await get_setting("target_temp", "CHYBA")
+    db_volume = await get_setting("tank_volume", "CHYBA")
     return {
         "ram": {
             "target_temp": SETTINGS["target_temp"],
@@ -626,6 +1491,21 @@ async def debug_settings():
             "target_temp": db_target,
             "tank_volume": db_volume
         },
-        "current_data_target": current_data["target_temp"],
+        "current_data_target": current_data.target_temp,
         "heater_cmd": heater_cmd
     }
+
+if __name__ == "__main__":
+    import uvicorn
+    # loop/http "auto" zvolí uvloop a httptools, pokud jsou nainstalované (mimo Windows),
+    # jinak standardní asyncio a h11. Access log je vypnutý - ESP32 posílá data
+    # několikrát za minutu a formátování řádku za každý request je zbytečná práce.
+    # Předáváme přímo objekt app - řetězec "main:app" by modul importoval podruhé
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=int(os.environ.get("PORT", 8000)),
+        loop="auto",
+        http="auto",
+        access_log=False,
+    )
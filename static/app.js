@@ -0,0 +1,321 @@
+// Ovládání termostatu
+const targetValue = document.getElementById('targetValue');
+const tempSlider = document.getElementById('tempSlider');
+const tempUp = document.getElementById('tempUp');
+const tempDown = document.getElementById('tempDown');
+const statusSaved = document.getElementById('statusSaved');
+const volumeInput = document.getElementById('volumeInput');
+let currentTarget = parseFloat(tempSlider.value);
+let currentVolume = parseInt(volumeInput.value);
+let saveTimeout;
+let targetPending = false;  // Změna cílové teploty ještě není uložená na serveru
+
+// Aktualizace zobrazení
+function updateDisplay() {
+    targetValue.textContent = currentTarget.toFixed(1);
+    tempSlider.value = currentTarget;
+}
+
+// Tlačítka +/-
+tempUp.addEventListener('click', function() {
+    if (currentTarget < 30) {
+        currentTarget = Math.min(30, currentTarget + 0.5);
+        updateDisplay();
+        sendTargetTemp(currentTarget);
+    }
+});
+
+tempDown.addEventListener('click', function() {
+    if (currentTarget > 18) {
+        currentTarget = Math.max(18, currentTarget - 0.5);
+        updateDisplay();
+        sendTargetTemp(currentTarget);
+    }
+});
+
+// Posuvník
+tempSlider.addEventListener('input', function() {
+    currentTarget = parseFloat(this.value);
+    updateDisplay();
+    sendTargetTemp(currentTarget);
+});
+
+// Odeslání cílové teploty na server
+async function sendTargetTemp(value) {
+    clearTimeout(saveTimeout);
+    targetPending = true;
+
+    saveTimeout = setTimeout(async () => {
+        try {
+            const response = await fetch('http://192.168.50.212:8000/set_target', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                },
+                body: JSON.stringify({ target_temp: parseFloat(value) })
+            });
+
+            if (response.ok) {
+                statusSaved.classList.add('show');
+                setTimeout(() => {
+                    statusSaved.classList.remove('show');
+                }, 2000);
+            }
+        } catch (error) {
+            console.error('Chyba při nastavování cílové teploty:', error);
+        } finally {
+            targetPending = false;
+        }
+    }, 300);
+}
+
+// Odeslání objemu akvária na server
+async function sendVolume(value) {
+    try {
+        const response = await fetch('http://192.168.50.212:8000/set_target', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({ tank_volume: parseInt(value) })
+        });
+
+        if (response.ok) {
+            statusSaved.classList.add('show');
+            setTimeout(() => {
+                statusSaved.classList.remove('show');
+            }, 2000);
+        }
+    } catch (error) {
+        console.error('Chyba při nastavování objemu:', error);
+    }
+}
+
+// Změna objemu akvária
+volumeInput.addEventListener('change', function() {
+    currentVolume = parseInt(this.value) || 50;
+    if (currentVolume < 1) currentVolume = 1;
+    if (currentVolume > 1000) currentVolume = 1000;
+    this.value = currentVolume;
+    sendVolume(currentVolume);
+});
+
+// Dynamická změna barvy statusu systému podle stavu připojení ESP32
+function updateStatusBadge() {
+    const statusBadge = document.querySelector('.status-badge');
+    if (statusBadge) {
+        const statusText = statusBadge.textContent.toLowerCase();
+        if (statusText.includes('online')) {
+            statusBadge.classList.remove('offline');
+            statusBadge.classList.add('online');
+        } else {
+            statusBadge.classList.remove('online');
+            statusBadge.classList.add('offline');
+        }
+    }
+}
+updateStatusBadge();
+
+// Cílová teplota a objem změněné z jiného zařízení - rozpracovanou změnu
+// (neuložený posuvník, právě editovaný objem) nepřepisujeme
+function applySettings(target, volume) {
+    if (!targetPending && !Number.isNaN(target)) {
+        currentTarget = target;
+        updateDisplay();
+    }
+    if (document.activeElement !== volumeInput && !Number.isNaN(volume)) {
+        currentVolume = volume;
+        volumeInput.value = volume;
+    }
+}
+
+// Pomocné funkce pro přepis hodnot na stránce
+function setText(id, text) {
+    const el = document.getElementById(id);
+    if (el) el.textContent = text;
+}
+
+function setClass(id, className) {
+    const el = document.getElementById(id);
+    if (el) el.className = className;
+}
+
+// Stejné prahy a texty jako v šabloně index.html
+function wqiLevel(wqi) {
+    if (wqi >= 80) return 'excellent';
+    if (wqi >= 60) return 'good';
+    if (wqi >= 40) return 'warning';
+    return 'danger';
+}
+
+function wqiText(wqi) {
+    if (wqi >= 80) return 'Vynikající kvalita';
+    if (wqi >= 60) return 'Dobrá kvalita';
+    if (wqi >= 40) return 'Průměrná kvalita';
+    return 'Špatná kvalita';
+}
+
+function stabilityLevel(sigma) {
+    if (sigma < 0.5) return 'excellent';
+    if (sigma < 1.0) return 'good';
+    return 'warning';
+}
+
+// [třída hodnoty, číslo, jednotka, třída popisu, popis]
+function prediction(days) {
+    if (days === null) return ['good', '—', '', '', 'Sbírám data pro predikci...'];
+    if (days === 0) return ['danger', 'Nyní', '', 'warning', 'Výměna vody nutná ihned!'];
+    if (days <= 3) return ['warning', days, 'dní', 'warning', 'Blíží se výměna vody'];
+    return ['good', days, 'dní', 'good', 'Do další výměny vody'];
+}
+
+const ADVICE_ICONS = { ok: '✅', danger: '🚨' };
+
+function renderAdvice(advice) {
+    const list = document.querySelector('[data-live="advice"]');
+    if (!list) return;
+    const items = advice.length ? advice : [{ type: 'ok', text: 'Čekám na data ze senzorů...' }];
+    list.replaceChildren(...items.map(item => {
+        const row = document.createElement('div');
+        row.className = `advice-item ${item.type}`;
+        const icon = document.createElement('span');
+        icon.className = 'advice-icon';
+        icon.textContent = ADVICE_ICONS[item.type] || '⚠️';
+        const text = document.createElement('span');
+        text.textContent = item.text;
+        row.append(icon, text);
+        return row;
+    }));
+}
+
+// Bity masky alert_bits - stejné jako ALERT_* v main.py
+const ALERT_TEMP = 1 << 0;
+const ALERT_PH = 1 << 1;
+const ALERT_TURBIDITY = 1 << 2;
+const ALERT_TDS = 1 << 3;
+const ALERT_WATER_LEVEL = 1 << 4;
+
+// [bit, karta, stavový text, text při alertu, text v normě]
+const ALERT_CARDS = [
+    [ALERT_PH, 'phCard', 'phStatus', '⚠️ Mimo rozsah', '✓ V normě'],
+    [ALERT_TURBIDITY, 'turbidityCard', 'turbidityStatus', '⚠️ Vysoký zákal', '✓ Čistá voda'],
+    [ALERT_TDS, 'tdsCard', 'tdsStatus', '⚠️ Vysoká hodnota', '✓ V normě'],
+    [ALERT_WATER_LEVEL, 'waterCard', 'waterStatus', '⚠️ Nízká hladina', '✓ OK'],
+];
+
+// Server posílá alerty jen jako masku - rozepíšeme ji na třídy a texty
+function renderAlerts(mask) {
+    const alertBadge = document.getElementById('alertBadge');
+    if (alertBadge) alertBadge.hidden = mask === 0;
+
+    const tempAlert = (mask & ALERT_TEMP) !== 0;
+    setClass('tempSection', tempAlert ? 'current-temp-section alert' : 'current-temp-section');
+    setClass('tempBadge', `temp-status-badge ${tempAlert ? 'warning' : 'ok'}`);
+    setText('tempBadge', tempAlert ? '⚠️ Mimo rozsah' : '✓ V normě');
+
+    for (const [bit, card, status, alertText, okText] of ALERT_CARDS) {
+        const alert = (mask & bit) !== 0;
+        setClass(card, alert ? 'card alert' : 'card');
+        setClass(status, `status-text ${alert ? 'warning' : 'ok'}`);
+        setText(status, alert ? alertText : okText);
+    }
+    setClass('water-fill', `water-level-fill ${mask & ALERT_WATER_LEVEL ? 'low' : 'ok'}`);
+}
+
+function setRelay(prefix, on) {
+    setClass(`${prefix}Indicator`, `relay-indicator ${on ? 'on' : 'off'}`);
+    setClass(`${prefix}State`, `relay-state ${on ? 'on' : 'off'}`);
+    setText(`${prefix}State`, on ? 'Zapnuto' : 'Vypnuto');
+}
+
+// Živá data: server po každé změně pošle přes WebSocket celý stav jako JSON
+// a stránka z něj přímo přepíše hodnoty - bez dalšího požadavku na server
+function renderState(state) {
+    setText('statusText', state.status);
+    setText('deviceName', state.device_name);
+    updateStatusBadge();
+
+    setText('currentTemp', state.temp === -127 ? '--' : state.temp.toFixed(1));
+    setClass('heaterSection', `heater-section ${state.heater_state ? 'heating' : 'idle'}`);
+    setText('heaterIcon', state.heater_state ? '🔥' : '❄️');
+    setText('heaterText', state.heater_state ? 'TOPÍ SE' : 'VYPNUTO');
+    applySettings(state.target_temp, state.tank_volume);
+
+    renderAdvice(state.advice);
+
+    const wqi = state.wqi;
+    const wqiCircle = document.getElementById('wqiCircle');
+    if (wqiCircle) wqiCircle.style.setProperty('--wqi-percent', wqi);
+    setText('wqiNumber', wqi);
+    setClass('wqiNumber', `wqi-number ${wqiLevel(wqi)}`);
+    setText('wqiDescription', wqiText(wqi));
+    setClass('wqiDescription', `metric-description ${wqi >= 80 ? 'excellent' : wqi >= 60 ? 'good' : 'warning'}`);
+
+    const stability = stabilityLevel(state.temp_stability);
+    setText('stabilityNumber', state.temp_stability.toFixed(2));
+    setClass('stabilityValue', `metric-value ${stability}`);
+    setText('stabilityDescription', state.temp_stability_text);
+    setClass('stabilityDescription', `metric-description ${stability}`);
+
+    const [valueClass, number, unit, descriptionClass, description] = prediction(state.tds_prediction_days);
+    setClass('predictionValue', `metric-value ${valueClass}`);
+    setText('predictionNumber', number);
+    setText('predictionUnit', unit);
+    setClass('predictionDescription', `metric-description ${descriptionClass}`.trim());
+    setText('predictionDescription', description);
+    setText('historyCount', state.history_count);
+
+    setText('phValue', state.ph.toFixed(1));
+    setText('turbidityValue', state.turbidity.toFixed(1));
+    setText('tdsValue', state.tds);
+    setText('waterValue', state.water_level);
+    const waterFill = document.getElementById('water-fill');
+    if (waterFill) waterFill.style.width = `${state.water_level}%`;
+    setRelay('pump', state.pump_state);
+    setRelay('heaterRelay', state.heater_state);
+
+    renderAlerts(state.alert_bits);
+
+    const lastUpdate = document.querySelector('[data-live="last-update"]');
+    if (lastUpdate) lastUpdate.textContent = state.last_update;
+}
+
+// Obnovení celé stránky (záloha bez WebSocketu a detekce Offline):
+// stáhne aktuální HTML a vymění jen bloky s daty (data-live)
+async function applyState() {
+    try {
+        const response = await fetch('/', { cache: 'no-cache' });
+        if (!response.ok) return;
+        const doc = new DOMParser().parseFromString(await response.text(), 'text/html');
+        doc.querySelectorAll('[data-live]').forEach(fresh => {
+            const current = document.querySelector(`[data-live="${fresh.dataset.live}"]`);
+            if (current) current.replaceWith(fresh);
+        });
+        applySettings(parseFloat(doc.getElementById('tempSlider').value),
+                      parseInt(doc.getElementById('volumeInput').value));
+        updateStatusBadge();
+    } catch (error) {
+        console.error('Chyba při obnovení dat:', error);
+    }
+}
+
+// Záloha bez WebSocketu: obnovení každých 5 s a nový pokus o připojení
+let pollTimer = null;
+function connectLive() {
+    const protocol = location.protocol === 'https:' ? 'wss' : 'ws';
+    const ws = new WebSocket(`${protocol}://${location.host}/ws`);
+    ws.onopen = () => {
+        clearInterval(pollTimer);
+        pollTimer = null;
+    };
+    ws.onmessage = (event) => renderState(JSON.parse(event.data));
+    ws.onclose = () => {
+        if (!pollTimer) pollTimer = setInterval(applyState, 5000);
+        setTimeout(connectLive, 5000);
+    };
+}
+connectLive();
+
+// Když ESP32 přestane posílat, nepřijde ani zpráva - stav Offline
+// se proto dočte pomalým obnovením jednou za 20 s
+setInterval(applyState, 20000);